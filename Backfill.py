@@ -0,0 +1,273 @@
+"""
+Rebuild player-state, level-state and transitions from archived enriched event files.
+
+Files (plain or gzipped TSV) are parsed in parallel with transform_batch(), the player
+updates are replayed in collector time order through the StateAggregator, players
+not seen for DELETE_OLDER_THAN_SECS before --as-of are marked MIA, and the final
+state is bulk loaded with batch writes.
+
+The load replaces what is in player-state and level-state: players the archive
+leaves active are written, every other player-state row is deleted, and every
+level-state row for a level with no active players is set to zero. Stop the
+SetPlayerState / SetLevelState / PrunePlayerLevel triggers while it runs, and
+afterwards delete their stream event source mappings and create them again at
+LATEST rather than re-enabling them - otherwise SetLevelState replays the load's own
+player-state writes on top of the counts it has just written.
+
+Transitions are not written to the live transitions table, whose counts cover one
+FlushTransitionState interval. The totals over the whole archive are written to
+s3://sp-codecombat-level-state/backfill_transition_information.json instead, in the
+same format as transition_information.json with update_interval_secs set to the
+time span the archive covers.
+
+Parsed updates are cached per input file under --state-dir, so a run that is
+interrupted picks up from the first file that had not finished parsing. They are
+sorted by time, then by the order the files were given and the line they came from,
+so updates in the same millisecond are applied in the order they were read.
+Each worker sorts its chunk, the sorted chunks of a file are merged into its cache,
+and the replay streams a merge of the caches - no step holds more than a chunk of
+updates in memory however large the archive is.
+
+Usage:
+    python Backfill.py archive/*.gz
+    python Backfill.py --output-dir out/ --as-of 2017-02-20T12:00:00Z archive/*.gz
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import gzip
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import boto3
+
+from SetPlayerState import transform_batch, get_player_levels, timenow_millis, ENRICHMENT_KEY, EVENT_FIELDS
+from StateAggregator import StateAggregator, read_chunks, write_tables, write_document, make_update, \
+    prune_duration_secs, tick_secs, LEVEL_FILE_NAME
+from StreamingSnapshot import scan_items
+
+MANIFEST_FILE_NAME = "manifest.json"
+CACHE_SUFFIX = ".updates.json.gz"
+PROGRESS_EVERY_CHUNKS = 10
+MERGE_FAN_IN = 64 # sorted runs open at once while merging
+BACKFILL_TRANSITION_FILE_NAME = "backfill_transition_information.json"
+
+
+def parse_chunk(lines, file_index, first_line):
+    # runs in a pool worker - returns the player updates found in a chunk of lines,
+    # as (timestamp, file index, line number, player, level) in time order
+    # updates in the same millisecond stay in the order they were read, as SetPlayerState would apply them
+    columns, errors = transform_batch(lines, EVENT_FIELDS)
+    updates = []
+
+    for i in range(len(lines)):
+        if errors[i] is None and columns[ENRICHMENT_KEY][i] is not None:
+            for player_id, level_id, timestamp in get_player_levels(columns[ENRICHMENT_KEY][i], columns['collector_tstamp'][i]):
+                updates.append((timestamp, file_index, first_line + i, player_id, level_id))
+
+    # stable, so contexts on the same line keep their order too
+    updates.sort(key=lambda update: update[:3])
+    return updates, len(errors) - errors.count(None), len(lines)
+
+def load_manifest(state_dir):
+    try:
+        with open(os.path.join(state_dir, MANIFEST_FILE_NAME)) as f:
+            return json.load(f)
+    except IOError:
+        return { 'parsed': {} }
+
+def save_manifest(state_dir, manifest):
+    # write then rename, so an interrupted save never leaves a half written manifest
+    path = os.path.join(state_dir, MANIFEST_FILE_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(path + '.tmp', path)
+
+def write_run(path, updates):
+    # a run is a gzipped file of updates, one json (timestamp, file index, line number, player, level) per line, in time order
+    with gzip.open(path, 'wb') as out:
+        for update in updates:
+            out.write((json.dumps(update) + '\n').encode('utf-8'))
+
+def read_run(path):
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+def merge_runs(paths, work_dir):
+    # returns an iterator over all the updates in paths, in time order
+    # runs are merged MERGE_FAN_IN at a time into work_dir until few enough are left to open together
+    generation = 0
+    while len(paths) > MERGE_FAN_IN:
+        merged = []
+        for i in range(0, len(paths), MERGE_FAN_IN):
+            merged_path = os.path.join(work_dir, "merge-{}-{}.json.gz".format(generation, i))
+            write_run(merged_path, heapq.merge(*[read_run(path) for path in paths[i:i + MERGE_FAN_IN]]))
+            merged.append(merged_path)
+        paths = merged
+        generation += 1
+
+    return heapq.merge(*[read_run(path) for path in paths])
+
+def reset_dir(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+def collect(pending, run_dir, runs, totals, limit):
+    # wait for the oldest chunks until no more than limit are outstanding, writing each out as a run
+    while len(pending) > limit:
+        updates, bad, lines = pending.popleft().get()
+        if updates:
+            runs.append(os.path.join(run_dir, "{:08d}.json.gz".format(len(runs))))
+            write_run(runs[-1], updates)
+        totals['updates'] += len(updates)
+        totals['bad'] += bad
+        totals['lines'] += lines
+
+def parse_file(pool, path, file_index, cache_path, chunk_size, max_pending):
+    # only a bounded number of chunks are in flight, so a large file is never read into memory
+    pending = collections.deque()
+    totals = { 'lines': 0, 'updates': 0, 'bad': 0 }
+    started = time.time()
+
+    run_dir = cache_path + '.runs'
+    reset_dir(run_dir)
+    runs = []
+
+    for n, chunk in enumerate(read_chunks(path, chunk_size), 1):
+        pending.append(pool.apply_async(parse_chunk, (chunk, file_index, (n - 1) * chunk_size)))
+        collect(pending, run_dir, runs, totals, max_pending)
+
+        if n % PROGRESS_EVERY_CHUNKS == 0:
+            elapsed = max(time.time() - started, 0.001)
+            print("{}: {} line(s), {} player update(s), {} bad line(s), {:.0f} lines/s".format(
+                path, totals['lines'], totals['updates'], totals['bad'], totals['lines'] / elapsed))
+
+    collect(pending, run_dir, runs, totals, 0)
+
+    write_run(cache_path + '.tmp', merge_runs(runs, run_dir))
+    os.rename(cache_path + '.tmp', cache_path)
+    shutil.rmtree(run_dir)
+    print("{}: done - {} line(s), {} player update(s), {} bad line(s) in {:.0f}s".format(
+        path, totals['lines'], totals['updates'], totals['bad'], time.time() - started))
+    return totals
+
+def parse_files(paths, state_dir, processes, chunk_size):
+    manifest = load_manifest(state_dir)
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for i, path in enumerate(paths, 1):
+            path = os.path.abspath(path)
+            size = os.path.getsize(path)
+            done = manifest['parsed'].get(path)
+
+            cache_name = hashlib.md5(path.encode('utf-8')).hexdigest() + CACHE_SUFFIX
+
+            if done is not None and done['size'] == size and done['cache'] == cache_name and \
+               os.path.exists(os.path.join(state_dir, cache_name)):
+                print("[{}/{}] {} already parsed - skipping".format(i, len(paths), path))
+                continue
+
+            print("[{}/{}] parsing {}".format(i, len(paths), path))
+            totals = parse_file(pool, path, i, os.path.join(state_dir, cache_name), chunk_size, processes * 2)
+
+            manifest['parsed'][path] = { 'size': size, 'cache': cache_name, 'totals': totals }
+            save_manifest(state_dir, manifest)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [os.path.join(state_dir, manifest['parsed'][os.path.abspath(path)]['cache']) for path in paths]
+
+def replay(cache_paths, state_dir, as_of):
+    # player updates have to be applied in time order for the transitions to come out right
+    work_dir = os.path.join(state_dir, 'replay')
+    reset_dir(work_dir)
+
+    aggregator = StateAggregator(prune_duration_secs * 1000, tick_secs * 1000)
+    replayed = 0
+    first = None
+    for timestamp, file_index, line_number, player_id, level_id in merge_runs(cache_paths, work_dir):
+        if first is None:
+            first = timestamp
+        aggregator.expire(timestamp)
+        aggregator.update(player_id, level_id, timestamp)
+        replayed += 1
+
+    span_secs = (aggregator.clock - first) // 1000 if first is not None else 0
+    aggregator.expire(as_of)
+    shutil.rmtree(work_dir)
+    print("Replayed {} player update(s) covering {}s".format(replayed, span_secs))
+    return aggregator, span_secs
+
+def clear_untouched(aggregator, levels):
+    # rows the archive doesn't account for are left over from before the rebuild
+    dynamodb = boto3.resource('dynamodb')
+    removed = 0
+    zeroed = 0
+
+    player_table = dynamodb.Table('player-state')
+    with player_table.batch_writer(overwrite_by_pkeys=['playerId']) as batch:
+        for i in scan_items(player_table, ProjectionExpression="playerId"):
+            if i['playerId'] not in aggregator.player_levels:
+                batch.delete_item(Key={'playerId': i['playerId']})
+                removed += 1
+
+    written = set(level for level, count in levels)
+    level_table = dynamodb.Table('level-state')
+    with level_table.batch_writer(overwrite_by_pkeys=['levelId']) as batch:
+        for i in scan_items(level_table, ProjectionExpression="levelId"):
+            if i['levelId'] not in written and i['levelId'] not in aggregator.level_counts:
+                batch.put_item(Item={'levelId': i['levelId'], 'playerCount': 0})
+                zeroed += 1
+
+    print("Removed {} player(s) and zeroed {} level(s) not in the archive".format(removed, zeroed))
+
+def load(aggregator, span_secs, output_dir=None):
+    players, levels, transitions = aggregator.drain()
+    print("Loading {} player(s), {} level(s), {} transition(s)".format(len(players), len(levels), len(transitions)))
+
+    if output_dir is None:
+        write_tables(players, levels)
+        clear_untouched(aggregator, levels)
+    else:
+        write_document(output_dir, LEVEL_FILE_NAME, make_update('level_player_counts', aggregator.level_counts, span_secs))
+
+    write_document(output_dir, BACKFILL_TRANSITION_FILE_NAME, make_update('transitions', transitions, span_secs))
+
+def parse_time(value):
+    utc_dt = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    return int((utc_dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild player, level and transition state from enriched event files")
+    parser.add_argument('files', nargs='+', help="enriched event TSV files, optionally gzipped")
+    parser.add_argument('--state-dir', default='backfill-state',
+                        help="where parsed updates and progress are kept between runs")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=10000, help="lines handed to a worker at a time")
+    parser.add_argument('--as-of', type=parse_time,
+                        help="time (YYYY-MM-DDTHH:MM:SSZ) used to decide which players are MIA, defaults to now")
+    parser.add_argument('--output-dir',
+                        help="write the level and transition documents here instead of loading DynamoDB and S3")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.state_dir):
+        os.makedirs(args.state_dir)
+
+    cache_paths = parse_files(args.files, args.state_dir, args.processes, args.chunk_size)
+    aggregator, span_secs = replay(cache_paths, args.state_dir, args.as_of if args.as_of is not None else timenow_millis())
+    load(aggregator, span_secs, args.output_dir)
+
+if __name__ == '__main__':
+    main()
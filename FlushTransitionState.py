@@ -3,10 +3,13 @@ import boto3
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 import decimal
-from cStringIO import StringIO
+import tempfile
 import uuid
 import datetime
 
+from StreamingSnapshot import scan_items, iter_json_document, S3StreamWriter
+from Profiling import profiled
+
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('transitions')
 s3_client = boto3.client('s3')
@@ -24,6 +27,7 @@ class DecimalEncoder(json.JSONEncoder):
 
 def empty_transition_table(keys):
     # empty the table here
+    deleted = 0
     for key in keys:
         print("Deleting transition information for '{}'".format(key))
         response = table.delete_item(
@@ -32,9 +36,10 @@ def empty_transition_table(keys):
             }
         )
         print("{}".format(response))
+        deleted += 1
 
     # return the number of records deleted
-    return len(keys)
+    return deleted
 
 def make_key(from_level, to_level):
     f=from_level
@@ -47,64 +52,41 @@ def make_key(from_level, to_level):
 
     return "{}/{}".format(f, t)
 
-def get_transition_table():
+def get_transition_table(keys_file):
     pe = "#from, #to, #tot"
     ean = { "#from": "levelFrom", "#to": "levelTo", "#tot": "count" }
 
-    response = table.scan(
-        ProjectionExpression=pe,
-        ExpressionAttributeNames=ean,
-        ConsistentRead=True
-    )
-
-    recs = []
-    keys = []
-
-    # get all the records
-    # NB that dynamodb scans return "pages", which is why we have to repeatedly
-    # call this in a while loop
-    for i in response['Items']:
+    # yield the records one at a time as dictionaries (rows)
+    # but also write the dynamodb primary key of each to keys_file - so we can remove them
+    # once the snapshot is safely in s3, without holding them all in memory
+    for i in scan_items(table, ProjectionExpression=pe, ExpressionAttributeNames=ean, ConsistentRead=True):
         row = { "from": i.get('levelFrom'), "to": i.get('levelTo'), "count": i['count'] }
-        recs.append(row)
-        keys.append(make_key(row['from'], row['to']))
-
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(
-            ProjectionExpression=pe,
-            ExpressionAttributeNames=ean,
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            ConsistentRead=True
-            )
+        keys_file.write(make_key(row['from'], row['to']).encode('utf-8') + b'\n')
+        yield row
 
-        for i in response['Items']:
-            row = { "from": i.get('levelFrom'), "to": i.get('levelTo'), "count": i['count'] }
-            recs.append(row)
-            keys.append(make_key(row['from'], row['to']))
+def read_keys(keys_file):
+    keys_file.seek(0)
+    for line in keys_file:
+        yield line.rstrip(b'\n').decode('utf-8')
 
-    # return the records as an array of dictionaries (rows)
-    # but also return the dynamodb primary keys of each - so we can remove them
-    return keys, recs
-
-def write_json_to_s3(json):
-    # write the json string to s3
-    print(json)
+def write_json_to_s3(chunks):
+    # stream the json to s3 - it is never held in memory as a whole
     bucket_name = "sp-codecombat-level-state"
     file_name = "transition_information.json"
-    fake_handle = StringIO(json)
-    s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=fake_handle.read())
-    return True
+    with S3StreamWriter(s3_client, bucket_name, file_name) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.size
 
+@profiled
 def lambda_handler(event, context):
-    keys, transition_table = get_transition_table()
-
     update = { 'update_time': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
                'update_id' : str(uuid.uuid4()),
-               'update_interval_secs': 60,
-               'transitions' : transition_table }
-
-    update_json = json.dumps(update, indent=2, cls=DecimalEncoder)
+               'update_interval_secs': 60 }
 
-    write_json_to_s3(update_json)
-    recs = empty_transition_table(keys)
+    with tempfile.TemporaryFile() as keys_file:
+        transition_table = get_transition_table(keys_file)
+        size = write_json_to_s3(iter_json_document(update, 'transitions', transition_table, cls=DecimalEncoder))
+        recs = empty_transition_table(read_keys(keys_file))
 
-    return "{}".format(update_json)
+    return "Wrote {} bytes to transition_information.json for update {}, {} transition(s) cleared".format(size, update['update_id'], recs)
@@ -0,0 +1,105 @@
+"""
+Opt-in stack sampling profiler for the lambda handlers.
+
+Decorate a handler with @profiled and set PROFILE_SAMPLE_RATE (0 - 1, the fraction
+of invocations to profile) or PROFILE_ENABLED=1 (profile every invocation). While
+a profiled invocation runs, a background thread records the handler's stack every
+PROFILE_INTERVAL_MS milliseconds, and the samples are written in collapsed-stack
+format (one "frame;frame;frame count" line per distinct stack, as read by
+flamegraph.pl and speedscope) to PROFILE_OUTPUT - a local directory, or
+s3://bucket/prefix. Deploy this file alongside each handler.
+
+When profiling is off the wrapper costs one comparison per invocation.
+"""
+
+from __future__ import print_function
+
+import functools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+sample_rate = 1.0 if os.getenv('PROFILE_ENABLED', '0') == '1' else float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+interval_secs = int(os.getenv('PROFILE_INTERVAL_MS', '10')) / 1000.0
+output = os.getenv('PROFILE_OUTPUT', '/tmp/profiles')
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread from a background thread, counting how many
+    times each distinct stack is seen.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename).rsplit('.', 1)[0], code.co_name))
+                frame = frame.f_back
+
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self):
+        return ''.join("{} {}\n".format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+def write_profile(name, collapsed):
+    file_name = "{}-{}.collapsed".format(name, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()))
+
+    if output.startswith('s3://'):
+        import boto3
+        bucket, _, prefix = output[len('s3://'):].partition('/')
+        key = prefix.rstrip('/') + '/' + file_name if prefix else file_name
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=collapsed)
+        return "s3://{}/{}".format(bucket, key)
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    path = os.path.join(output, file_name)
+    with open(path, 'w') as f:
+        f.write(collapsed)
+    return path
+
+def profiled(handler):
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return handler(event, context)
+
+        sampler = StackSampler(threading.current_thread().ident, interval_secs)
+        sampler.start()
+        try:
+            return handler(event, context)
+        finally:
+            sampler.stop()
+            name = "{}-{}".format(getattr(context, 'function_name', handler.__module__),
+                                  getattr(context, 'aws_request_id', uuid.uuid4()))
+            # a profile that can't be written must never fail the invocation
+            try:
+                print("Profile written to {}".format(write_profile(name, sampler.collapsed())))
+            except Exception as e:
+                print("Failed to write profile: {}".format(repr(e)))
+
+    return wrapper
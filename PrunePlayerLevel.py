@@ -6,6 +6,8 @@ import time
 import os
 from botocore.exceptions import ClientError
 
+from Profiling import profiled
+
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('player-state')
 prune_duration_secs = int(os.getenv('DELETE_OLDER_THAN_SECS', '300')) # default to 5 minutes
@@ -68,6 +70,7 @@ def clean_mia_players():
 
     return players_pruned
 
+@profiled
 def lambda_handler(event, context):
     total = clean_mia_players()
     msg = "{} players MIA".format(total)
@@ -3,6 +3,8 @@ from __future__ import print_function
 import json
 import boto3
 
+from Profiling import profiled
+
 print('Loading function')
 
 dynamodb = boto3.resource('dynamodb')
@@ -79,6 +81,7 @@ def write_transition(old_level, new_level):
         else:
             raise ValueError("Unexpected error - level change does not meet transition criteria")
 
+@profiled
 def lambda_handler(event, context):
     print(json.dumps(event, indent=2))
 
@@ -3,12 +3,18 @@ from __future__ import print_function
 import json
 import random
 import time
+import os
+import math
+import struct
+import hashlib
 import boto3
 from botocore.exceptions import ClientError
 import decimal
 from boto3.dynamodb.conditions import Key, Attr
 from datetime import datetime
 
+from Profiling import profiled
+
 print('Loading function')
 
 dynamodb = boto3.resource('dynamodb')
@@ -16,6 +22,14 @@ table = dynamodb.Table('player-state')
 
 ENRICHMENT_KEY = "contexts_com_codecombat_level_context_1"
 
+# the only fields lambda_handler reads from each event
+EVENT_FIELDS = ('event_id', 'event_fingerprint', 'collector_tstamp', ENRICHMENT_KEY)
+
+# duplicate suppression - sized for the number of distinct events expected in one window
+dedup_capacity = int(os.getenv('DEDUP_CAPACITY', '100000'))
+dedup_error_rate = float(os.getenv('DEDUP_ERROR_RATE', '0.001'))
+dedup_window_secs = int(os.getenv('DEDUP_WINDOW_SECS', '600')) # default to 10 minutes
+
 
 def timenow_millis():
     return int(round(time.time() * 1000))
@@ -43,54 +57,225 @@ def update_player_level(player, level, timestamp):
         else:
             raise
 
+# KPL aggregated records - magic, then a protobuf AggregatedRecord, then the md5 of the protobuf
+# https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+KPL_DIGEST_SIZE = 16
+KPL_RECORDS_FIELD = 3 # AggregatedRecord.records
+KPL_DATA_FIELD = 3    # Record.data
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos:pos + 1])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def read_fields(data, start, end):
+    # walk the protobuf message in data[start:end], yielding (field number, value)
+    # length delimited values are yielded as (start, end) offsets so nothing is copied here
+    pos = start
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x7
+
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 1:
+            value = None
+            pos += 8
+        elif wire_type == 5:
+            value = None
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+
+        yield field, value
+
+    if pos != end:
+        raise ValueError("Protobuf message overruns its buffer")
+
+def deaggregate(data):
+    # return the user records in a (possibly KPL aggregated) kinesis record
+    if not data.startswith(KPL_MAGIC) or len(data) < len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+        return [data]
+
+    start = len(KPL_MAGIC)
+    end = len(data) - KPL_DIGEST_SIZE
+
+    # same as the KCL - a record with the magic but the wrong digest is passed through as is
+    if hashlib.md5(memoryview(data)[start:end]).digest() != data[end:]:
+        print("Record has the KPL magic number but its digest does not match - treating as a single record")
+        return [data]
+
+    sub_records = []
+    try:
+        for field, value in read_fields(data, start, end):
+            if field == KPL_RECORDS_FIELD:
+                for record_field, record_value in read_fields(data, value[0], value[1]):
+                    if record_field == KPL_DATA_FIELD:
+                        sub_records.append(data[record_value[0]:record_value[1]])
+    except (ValueError, TypeError) as e:
+        print("Ignoring badly formatted KPL aggregated record: {}".format(e))
+        return []
+
+    return sub_records
+
 def get_records(update):
     data = []
     if "Records" in update:
         for record in update["Records"]:
             if "kinesis" in record and "data" in record['kinesis']:
                 decoded_data = record['kinesis']['data'].decode('base64')
-                data.append(decoded_data)
+                data.extend(deaggregate(decoded_data))
     return data
 
+class BloomFilter(object):
+    """
+    Fixed size set membership test - may report false positives, never false negatives
+    """
+    def __init__(self, capacity, error_rate):
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits * math.log(2) / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, key):
+        # double hashing - derive all the bit positions from one md5
+        # h2 is made odd so successive positions can't fall into a short cycle
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+class EventDeduplicator(object):
+    """
+    Remembers events seen by this container over the last one to two windows.
+
+    Two filters are kept - when the current one is a window old, or has had capacity
+    keys added to it, it becomes the previous one and the oldest is dropped, so memory
+    stays at two filters however long the container lives. Rotating on capacity keeps
+    the false positive rate at error_rate under heavy traffic, at the cost of a
+    shorter window.
+    """
+    def __init__(self, capacity, error_rate, window_millis):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window_millis = window_millis
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.added = 0 # keys added to the current filter
+        self.rotated_at = timenow_millis()
+        self.suppressed = 0
+
+    def rotate(self):
+        now = timenow_millis()
+        if now - self.rotated_at >= self.window_millis or self.added >= self.capacity:
+            if self.added >= self.capacity:
+                print("Duplicate filter full after {}s - rotating early".format((now - self.rotated_at) // 1000))
+            # if more than two windows have passed nothing in the current filter is worth keeping either
+            self.previous = self.current if now - self.rotated_at < 2 * self.window_millis else None
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.added = 0
+            self.rotated_at = now
+
+    def seen(self, key):
+        self.rotate()
+        if key in self.current or (self.previous is not None and key in self.previous):
+            self.suppressed += 1
+            return True
+        return False
+
+    def add(self, key):
+        self.current.add(key)
+        self.added += 1
+
+def get_event_key(event_id, event_fingerprint):
+    # enriched events are identified by their event id plus fingerprint
+    # (event_id alone is not unique - some trackers reuse it)
+    if event_id is None and event_fingerprint is None:
+        return None
+
+    return "{}/{}".format(event_id or "", event_fingerprint or "")
+
+deduplicator = EventDeduplicator(dedup_capacity, dedup_error_rate, dedup_window_secs * 1000)
+
+def get_player_levels(level_contexts, collector_tstamp):
+    # pull (player, level, timestamp) out of each level context attached to an event
+    # timestamp is the collector time of the event in milliseconds
+    player_levels = []
+
+    for user_level_context in level_contexts:
+
+        if 'user_id' in user_level_context and 'level_slug' in user_level_context:
+            player_id = user_level_context['user_id']
+            level_id = user_level_context['level_slug']
+
+            utc_dt = datetime.strptime(collector_tstamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+            timestamp = (utc_dt - datetime(1970, 1, 1)).total_seconds() * 1000 # seconds -> milliseconds
+            timestamp = int(timestamp) # remove fractional milliseconds (timestamp is now an integer)
+
+            # sometimes these values are null, ignore those
+            if player_id is None or level_id is None:
+                print("{} is missing a player id ({}) or level id ({})".format(ENRICHMENT_KEY, player_id, level_id))
+            else:
+                player_levels.append((player_id, level_id, timestamp))
+        else:
+            print("{} in unexpected format - cannot find 'user_id' or 'level_slug'".format(ENRICHMENT_KEY))
+
+    return player_levels
+
+@profiled
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event, indent=2))
 
     records = get_records(event)
+    duplicates = 0
 
-    for record in records:
-        snowplow_event_json = None
+    # parse the whole batch in one go, keeping only the fields used below
+    columns, errors = transform_batch(records, EVENT_FIELDS)
 
-        try:
-            snowplow_event_json = transform(record)
-        except:
+    for i in range(len(records)):
+        if errors[i] is not None:
             print("Ignoring badly formatted record in stream (failed to parse with SP analytics SDK")
             continue
 
-        if ENRICHMENT_KEY in snowplow_event_json:
-
-            for user_level_context in snowplow_event_json[ENRICHMENT_KEY]:
-
-                if 'user_id' in user_level_context and 'level_slug' in user_level_context:
-                    player_id = user_level_context['user_id']
-                    level_id = user_level_context['level_slug']
+        # Kinesis delivers at least once and lambda retries whole batches, so the same event
+        # can turn up again - drop it before it costs another conditional write
+        event_key = get_event_key(columns['event_id'][i], columns['event_fingerprint'][i])
+        if event_key is not None and deduplicator.seen(event_key):
+            print("Ignoring duplicate event {}".format(event_key))
+            duplicates += 1
+            continue
 
-                    utc_dt = datetime.strptime(snowplow_event_json['collector_tstamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
-                    timestamp = (utc_dt - datetime(1970, 1, 1)).total_seconds() * 1000 # seconds -> milliseconds
-                    timestamp = int(timestamp) # remove fractional milliseconds (timestamp is now an integer)
+        if columns[ENRICHMENT_KEY][i] is not None:
+            player_levels = get_player_levels(columns[ENRICHMENT_KEY][i], columns['collector_tstamp'][i])
 
-                    # sometimes these values are null, ignore those
-                    if player_id is None or level_id is None:
-                        print("{} is missing a player id ({}) or level id ({})".format(ENRICHMENT_KEY, player_id, level_id))
-                    else:
-                        now = timenow_millis()
-                        print("player name = {}\ncurrent level = {}\ntimestamp = {}\ntime now = {}".format(player_id, level_id, timestamp, now))
-                        update_player_level(player_id, level_id, now)
-                else:
-                    print("{} in unexpected format - cannot find 'user_id' or 'level_slug'".format(ENRICHMENT_KEY))
+            for player_id, level_id, timestamp in player_levels:
+                now = timenow_millis()
+                print("player name = {}\ncurrent level = {}\ntimestamp = {}\ntime now = {}".format(player_id, level_id, timestamp, now))
+                update_player_level(player_id, level_id, now)
 
         else:
             print("Ignoring Snowplow JSON event without {} key".format(ENRICHMENT_KEY))
 
+        # only remember the event once it has been handled - if an update failed the retry must not be dropped
+        if event_key is not None:
+            deduplicator.add(event_key)
+
 
         # user id
         # level slug
@@ -104,7 +289,9 @@ def lambda_handler(event, context):
 
         #update_player_level(playerId, levelId, timestamp)
 
-    return "Successfully processed {} Kinesis Records(s)".format(len(records))
+    print("{} duplicate event(s) suppressed in this batch, {} since the container started".format(duplicates, deduplicator.suppressed))
+
+    return "Successfully processed {} Kinesis Records(s), {} duplicate(s) suppressed".format(len(records), duplicates)
 
 
 
@@ -328,19 +515,134 @@ def jsonify_good_event(event, known_fields=ENRICHED_EVENT_FIELD_TYPES, add_geolo
             return output
 
 
+def transform_batch(lines, fields, known_fields=ENRICHED_EVENT_FIELD_TYPES, add_geolocation_data=True):
+    """
+    Convert a batch of Snowplow enriched event TSVs, keeping only the requested fields
+
+    fields may name enriched event fields, geo_location, or the context and unstructured
+    event keys produced by transform (for example contexts_com_acme_duplicated_1).
+
+    Returns (columns, errors). columns maps each requested field to a list holding one
+    value per line, None where the line has no value for it. errors has one entry per
+    line - None if the line converted cleanly, otherwise its list of error messages (every
+    column is None for that line). Nothing is raised for a bad line. A field named more
+    than once gets a single column.
+    """
+    # a repeated field would otherwise get two values per line in its column
+    unique_fields = []
+    for field in fields:
+        if field not in unique_fields:
+            unique_fields.append(field)
+    fields = unique_fields
+
+    # work out once for the whole batch which columns have to be converted
+    field_indexes = dict((known_fields[i][0], i) for i in range(len(known_fields)))
+    plain = []          # (field, column index, converter) for fields copied straight from a column
+    derived = set()     # keys that only come out of a contexts / unstruct_event column
+    derived_columns = []
+    wants_geolocation = False
+
+    for field in fields:
+        if field in field_indexes:
+            i = field_indexes[field]
+            plain.append((field, i, known_fields[i][1]))
+        elif field == 'geo_location':
+            wants_geolocation = add_geolocation_data
+        else:
+            derived.add(field)
+
+    if derived:
+        for i in range(len(known_fields)):
+            key, converter = known_fields[i]
+            if (converter is convert_contexts and any(f.startswith('contexts_') for f in derived)) or \
+               (converter is convert_unstruct and any(f.startswith('unstruct_event_') for f in derived)):
+                derived_columns.append((key, i, converter))
+
+    columns = dict((field, []) for field in fields)
+    errors = []
+
+    for line in lines:
+        event = line.split('\t')
+        row = {}
+        row_errors = []
+
+        if len(event) != len(known_fields):
+            row_errors.append("Expected {} fields, received {} fields.".format(len(known_fields), len(event)))
+        else:
+            if wants_geolocation and event[LATITUDE_INDEX] != '' and event[LONGITUDE_INDEX] != '':
+                row['geo_location'] = event[LATITUDE_INDEX] + ',' + event[LONGITUDE_INDEX]
+
+            for key, i, converter in plain:
+                if event[i] != '':
+                    try:
+                        if converter is convert_string:
+                            row[key] = event[i]
+                        else:
+                            for kvpair in converter(key, event[i]):
+                                row[kvpair[0]] = kvpair[1]
+                    except SnowplowEventTransformationException as sete:
+                        row_errors += sete.error_messages
+                    except Exception as e:
+                        row_errors += ["Unexpected exception parsing field with key {} and value {}: {}".format(
+                            key,
+                            event[i],
+                            repr(e)
+                        )]
+
+            for key, i, converter in derived_columns:
+                if event[i] != '':
+                    try:
+                        for kvpair in converter(key, event[i]):
+                            if kvpair[0] in derived:
+                                row[kvpair[0]] = kvpair[1]
+                    except SnowplowEventTransformationException as sete:
+                        row_errors += sete.error_messages
+                    except Exception as e:
+                        row_errors += ["Unexpected exception parsing field with key {} and value {}: {}".format(
+                            key,
+                            event[i],
+                            repr(e)
+                        )]
+
+        if row_errors:
+            row = {}
+            errors.append(row_errors)
+        else:
+            errors.append(None)
+
+        for field in fields:
+            columns[field].append(row.get(field))
+
+    return columns, errors
+
+
 SCHEMA_PATTERN = re.compile(""".+:([a-zA-Z0-9_\.]+)/([a-zA-Z0-9_]+)/[^/]+/(.*)""")
 
 
+# fix_schema results - the same handful of schemas turn up on nearly every event
+# schemas come from event data, so the cache is emptied once it holds more than it should ever need
+FIXED_SCHEMAS = {}
+FIXED_SCHEMAS_LIMIT = 1000
+
+
 def fix_schema(prefix, schema):
     """
     Create an Elasticsearch field name from a schema string
     """
+    fixed = FIXED_SCHEMAS.get((prefix, schema))
+    if fixed is not None:
+        return fixed
+
     match = re.match(SCHEMA_PATTERN, schema)
     if match:
         snake_case_organization = match.group(1).replace('.', '_').lower()
         snake_case_name = re.sub('([^A-Z_])([A-Z])', '\g<1>_\g<2>', match.group(2)).lower()
         model = match.group(3).split('-')[0]
-        return "{}_{}_{}_{}".format(prefix, snake_case_organization, snake_case_name, model)
+        fixed = "{}_{}_{}_{}".format(prefix, snake_case_organization, snake_case_name, model)
+        if len(FIXED_SCHEMAS) >= FIXED_SCHEMAS_LIMIT:
+            FIXED_SCHEMAS.clear()
+        FIXED_SCHEMAS[(prefix, schema)] = fixed
+        return fixed
     else:
         raise SnowplowEventTransformationException([
             "Schema {} does not conform to regular expression {}".format(schema, SCHEMA_PATTERN)
@@ -0,0 +1,501 @@
+"""
+Long-running alternative to the SetPlayerState -> SetLevelState -> Prune/Write/Flush
+lambda pipeline.
+
+Player -> level, level player counts and level transitions are folded in memory,
+MIA players are expired with a timer wheel, and the results are checkpointed
+periodically: player-state and level-state rows are bulk written to DynamoDB, and
+level_information.json / transition_information.json are written to S3 in the same
+format as WriteLevelState and FlushTransitionState.
+
+When this runs against the live stream the SetPlayerState, SetLevelState,
+PrunePlayerLevel, WriteLevelState and FlushTransitionState triggers should be
+disabled - SetLevelState in particular, or the player-state rows written here would
+come back through the table's stream and be counted a second time. To hand back to
+the lambdas, delete the stream event source mappings and create them again at
+LATEST rather than re-enabling them, so the writes made here are not replayed.
+
+On startup the in-memory state is rebuilt from player-state, and each shard carries
+on after the sequence number stored with the last checkpoint
+(s3://sp-codecombat-level-state/state_aggregator/<stream>-positions.json). Records
+after that checkpoint are read again, so a restart loses nothing but may apply the
+same records twice.
+
+Usage:
+    python StateAggregator.py --stream <kinesis stream name>
+    python StateAggregator.py --file enriched.tsv --event-time --output-dir out/
+    cat enriched.tsv | python StateAggregator.py --file - --output-dir out/
+
+With --output-dir every checkpoint writes its own 000001-level_information.json /
+000001-transition_information.json pair, numbered in checkpoint order.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+from StreamingSnapshot import scan_items
+from SetPlayerState import transform_batch, deaggregate, get_player_levels, timenow_millis, ENRICHMENT_KEY, EVENT_FIELDS
+
+BUCKET_NAME = "sp-codecombat-level-state"
+LEVEL_FILE_NAME = "level_information.json"
+TRANSITION_FILE_NAME = "transition_information.json"
+
+prune_duration_secs = int(os.getenv('DELETE_OLDER_THAN_SECS', '300')) # default to 5 minutes
+checkpoint_interval_secs = int(os.getenv('CHECKPOINT_INTERVAL_SECS', '60'))
+tick_secs = int(os.getenv('TIMER_WHEEL_TICK_SECS', '1'))
+batch_size = int(os.getenv('BATCH_SIZE', '500')) # lines read from a file per transform_batch call
+poll_interval_secs = float(os.getenv('POLL_INTERVAL_SECS', '1')) # per shard
+max_backoff_secs = float(os.getenv('MAX_BACKOFF_SECS', '30'))
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel - keys are bucketed by the tick at which they expire, so
+    advancing the clock only looks at the buckets that have come due.
+
+    Keys are never removed when rescheduled; stale entries are returned by advance()
+    and it is up to the caller to check whether they have really expired, and to
+    schedule them again if not.
+    """
+    def __init__(self, timeout_millis, tick_millis):
+        self.tick_millis = tick_millis
+        self.slots = [set() for _ in range(timeout_millis // tick_millis + 2)]
+        self.current_tick = None
+
+    def schedule(self, key, expires_millis):
+        tick = expires_millis // self.tick_millis
+        if self.current_tick is not None and tick <= self.current_tick:
+            # already behind the wheel - make sure it comes up on the next tick
+            tick = self.current_tick + 1
+        self.slots[tick % len(self.slots)].add(key)
+
+    def advance(self, now_millis):
+        tick = now_millis // self.tick_millis
+        if self.current_tick is None:
+            # first call - anything scheduled so far (e.g. restored players) could already be due
+            self.current_tick = tick - len(self.slots)
+
+        due = []
+        # a full turn of the wheel visits every slot, so never go round more than once
+        for t in range(self.current_tick + 1, min(tick, self.current_tick + len(self.slots)) + 1):
+            slot = self.slots[t % len(self.slots)]
+            due.extend(slot)
+            slot.clear()
+
+        self.current_tick = max(self.current_tick, tick)
+        return due
+
+
+class StateAggregator(object):
+    """
+    In-memory equivalent of the player-state, level-state and transitions tables.
+
+    update() follows SetPlayerState (only newer records are applied), level changes
+    are applied the same way SetLevelState applies the (old level, new level) pairs
+    from get_level_changes, and expire() follows PrunePlayerLevel.
+    """
+    def __init__(self, timeout_millis, tick_millis):
+        self.timeout_millis = timeout_millis
+        self.clock = 0
+
+        self.player_levels = {}  # playerId -> levelId
+        self.player_updated = {} # playerId -> lastUpdated (millis)
+        self.level_counts = {}   # levelId -> playerCount (levels with no players are dropped)
+        self.transitions = {}    # (levelFrom, levelTo) -> count since the last checkpoint
+        self.level_ids = {}      # interned level ids, so each player shares one string per level
+
+        self.dirty_players = set()
+        self.dirty_levels = set()
+        self.wheel = TimerWheel(timeout_millis, tick_millis)
+        self.checkpoints = 0
+
+    def update(self, player, level, timestamp):
+        self.clock = max(self.clock, timestamp)
+
+        last_updated = self.player_updated.get(player)
+        if last_updated is not None and last_updated > timestamp:
+            # same as the lastUpdated condition in SetPlayerState - a newer record exists
+            return
+
+        level = self.level_ids.setdefault(level, level)
+        old_level = self.player_levels.get(player)
+
+        self.player_levels[player] = level
+        self.player_updated[player] = timestamp
+        self.dirty_players.add(player)
+        self.wheel.schedule(player, timestamp + self.timeout_millis)
+
+        self.apply_level_change(old_level, level)
+
+    def expire(self, now):
+        self.clock = max(self.clock, now)
+        expired = 0
+
+        for player in self.wheel.advance(self.clock):
+            last_updated = self.player_updated.get(player)
+            if last_updated is None:
+                # already gone
+                continue
+
+            if last_updated + self.timeout_millis > self.clock:
+                # seen again since this entry was scheduled, or scheduled more than a turn of the wheel ahead
+                self.wheel.schedule(player, last_updated + self.timeout_millis)
+                continue
+
+            old_level = self.player_levels.pop(player)
+            del self.player_updated[player]
+            self.dirty_players.add(player)
+            self.apply_level_change(old_level, None)
+            expired += 1
+
+        return expired
+
+    def restore(self, players):
+        # load (player, level, lastUpdated) rows saved by an earlier checkpoint
+        restored = 0
+
+        for player, level, last_updated in players:
+            level = self.level_ids.setdefault(level, level)
+            self.player_levels[player] = level
+            self.player_updated[player] = last_updated
+            self.level_counts[level] = self.level_counts.get(level, 0) + 1
+            self.dirty_levels.add(level)
+            self.wheel.schedule(player, last_updated + self.timeout_millis)
+            self.clock = max(self.clock, last_updated)
+            restored += 1
+
+        return restored
+
+    def apply_level_change(self, old_level, new_level):
+        if old_level == new_level:
+            return
+
+        key = (old_level, new_level)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+
+        if old_level is not None:
+            count = self.level_counts.get(old_level, 0) - 1
+            if count > 0:
+                self.level_counts[old_level] = count
+            else:
+                self.level_counts.pop(old_level, None)
+            self.dirty_levels.add(old_level)
+
+        if new_level is not None:
+            self.level_counts[new_level] = self.level_counts.get(new_level, 0) + 1
+            self.dirty_levels.add(new_level)
+
+    def drain(self):
+        # hand back everything changed since the last call, and start a new transition interval
+        players = [(p, self.player_levels.get(p), self.player_updated.get(p)) for p in self.dirty_players]
+        levels = [(l, self.level_counts.get(l, 0)) for l in self.dirty_levels]
+        transitions = [{ "from": f, "to": t, "count": c } for (f, t), c in self.transitions.items()]
+
+        self.dirty_players = set()
+        self.dirty_levels = set()
+        self.transitions = {}
+        self.checkpoints += 1
+
+        return players, levels, transitions
+
+
+def make_update(name, value, interval_secs):
+    return { 'update_time': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+             'update_id' : str(uuid.uuid4()),
+             'update_interval_secs': interval_secs,
+             name : value }
+
+def write_tables(players, levels):
+    dynamodb = boto3.resource('dynamodb')
+
+    with dynamodb.Table('player-state').batch_writer(overwrite_by_pkeys=['playerId']) as batch:
+        for player, level, last_updated in players:
+            if level is None:
+                batch.delete_item(Key={'playerId': player})
+            else:
+                batch.put_item(Item={'playerId': player, 'levelId': level, 'lastUpdated': last_updated})
+
+    with dynamodb.Table('level-state').batch_writer(overwrite_by_pkeys=['levelId']) as batch:
+        for level, count in levels:
+            batch.put_item(Item={'levelId': level, 'playerCount': count})
+
+def write_document(output_dir, file_name, document, sequence=None):
+    # locally each checkpoint gets its own numbered file, so a replay keeps every interval
+    as_json = json.dumps(document, indent=2)
+
+    if output_dir is None:
+        boto3.client('s3').put_object(Bucket=BUCKET_NAME, Key=file_name, Body=as_json)
+    else:
+        if sequence is not None:
+            file_name = "{:06d}-{}".format(sequence, file_name)
+        with open(os.path.join(output_dir, file_name), 'w') as f:
+            f.write(as_json)
+
+def position_key(stream_name):
+    return "state_aggregator/{}-positions.json".format(stream_name)
+
+def load_positions(stream_name, output_dir=None):
+    # shard id -> sequence number of the last record covered by the most recent checkpoint
+    try:
+        if output_dir is None:
+            response = boto3.client('s3').get_object(Bucket=BUCKET_NAME, Key=position_key(stream_name))
+            return json.loads(response['Body'].read())
+        with open(os.path.join(output_dir, os.path.basename(position_key(stream_name)))) as f:
+            return json.load(f)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+    except IOError:
+        pass
+
+    print("No stored positions for {} - starting at the tip of the stream".format(stream_name))
+    return {}
+
+def save_positions(stream_name, positions, output_dir=None):
+    as_json = json.dumps(positions, indent=2)
+
+    if output_dir is None:
+        boto3.client('s3').put_object(Bucket=BUCKET_NAME, Key=position_key(stream_name), Body=as_json)
+    else:
+        with open(os.path.join(output_dir, os.path.basename(position_key(stream_name))), 'w') as f:
+            f.write(as_json)
+
+def load_tables(aggregator):
+    # rebuild the in-memory state from the last checkpoint of player-state
+    dynamodb = boto3.resource('dynamodb')
+
+    players = scan_items(dynamodb.Table('player-state'),
+                         ProjectionExpression="playerId, levelId, lastUpdated", ConsistentRead=True)
+    restored = aggregator.restore((i['playerId'], i['levelId'], int(i['lastUpdated'])) for i in players if 'levelId' in i)
+
+    # every level with a row gets rewritten at the first checkpoint, so counts that drifted
+    # while nothing was running are corrected (to zero if nobody is on the level any more)
+    for i in scan_items(dynamodb.Table('level-state'), ProjectionExpression="levelId"):
+        aggregator.dirty_levels.add(i['levelId'])
+
+    print("Restored {} player(s) on {} level(s)".format(restored, len(aggregator.level_counts)))
+
+def checkpoint(aggregator, interval_secs, output_dir=None, stream_name=None, positions=None):
+    players, levels, transitions = aggregator.drain()
+
+    # DynamoDB is only kept up to date when running against AWS
+    if output_dir is None:
+        write_tables(players, levels)
+
+    write_document(output_dir, LEVEL_FILE_NAME, make_update('level_player_counts', aggregator.level_counts, interval_secs), aggregator.checkpoints)
+    write_document(output_dir, TRANSITION_FILE_NAME, make_update('transitions', transitions, interval_secs), aggregator.checkpoints)
+
+    # positions go last - if anything above fails the records since the previous checkpoint are read again
+    if positions is not None:
+        save_positions(stream_name, positions, output_dir)
+
+    print("Checkpoint: {} player(s) changed, {} level(s) changed, {} transition(s), {} player(s) active".format(
+        len(players), len(levels), len(transitions), len(aggregator.player_levels)))
+
+def read_file(path):
+    # yields one enriched event TSV line at a time; '-' reads stdin
+    if path == '-':
+        handle = sys.stdin
+    elif path.endswith('.gz'):
+        handle = io.TextIOWrapper(gzip.open(path), encoding='utf-8')
+    else:
+        handle = io.open(path, 'r', encoding='utf-8')
+
+    try:
+        for line in handle:
+            yield line.rstrip('\r\n')
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+def read_chunks(path, chunk_size):
+    # yields lists of up to chunk_size lines from read_file
+    lines = read_file(path)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def list_shards(kinesis, stream_name):
+    shards = []
+    response = kinesis.describe_stream(StreamName=stream_name)
+    shards.extend(response['StreamDescription']['Shards'])
+
+    while response['StreamDescription']['HasMoreShards']:
+        response = kinesis.describe_stream(StreamName=stream_name, ExclusiveStartShardId=shards[-1]['ShardId'])
+        shards.extend(response['StreamDescription']['Shards'])
+
+    return shards
+
+def get_shard_iterator(kinesis, stream_name, shard_id, sequence_number, iterator_type):
+    # carry on after the stored position if there is one, otherwise start at iterator_type
+    if sequence_number is not None:
+        response = kinesis.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
+                                              ShardIteratorType='AFTER_SEQUENCE_NUMBER', StartingSequenceNumber=sequence_number)
+    else:
+        response = kinesis.get_shard_iterator(StreamName=stream_name, ShardId=shard_id, ShardIteratorType=iterator_type)
+    return response['ShardIterator']
+
+def read_stream(stream_name, positions, poll_secs=poll_interval_secs):
+    """
+    Yield the records from each get_records call as a list.
+
+    Shards carry on from the sequence numbers in positions, or start at the tip of the
+    stream if there are none. positions is updated before each batch is yielded, so at
+    any point between batches it covers everything handed out. Each shard is polled at
+    most once every poll_secs (Kinesis allows 5 reads/s per shard), backing off further
+    while it is throttled. An empty list is yielded whenever no shard is due, so the
+    caller still gets to run its timers.
+    """
+    kinesis = boto3.client('kinesis')
+
+    iterators = {}
+    for shard in list_shards(kinesis, stream_name):
+        shard_id = shard['ShardId']
+        # closed shards are only worth reading if a previous run hadn't finished with them
+        if 'EndingSequenceNumber' not in shard['SequenceNumberRange'] or shard_id in positions:
+            iterators[shard_id] = get_shard_iterator(kinesis, stream_name, shard_id, positions.get(shard_id), 'LATEST')
+
+    next_poll = dict((shard_id, 0) for shard_id in iterators)
+    backoff = {}
+    closed = set()
+
+    while iterators:
+        now = time.time()
+        due = [shard_id for shard_id in iterators if next_poll[shard_id] <= now]
+
+        if not due:
+            yield []
+            time.sleep(max(0, min(next_poll.values()) - time.time()))
+            continue
+
+        for shard_id in due:
+            try:
+                response = kinesis.get_records(ShardIterator=iterators[shard_id], Limit=10000)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ProvisionedThroughputExceededException':
+                    backoff[shard_id] = min(backoff.get(shard_id, poll_secs) * 2, max_backoff_secs)
+                    next_poll[shard_id] = time.time() + backoff[shard_id]
+                    print("Reads from shard {} throttled - backing off for {}s".format(shard_id, backoff[shard_id]))
+                    continue
+                elif code == 'ExpiredIteratorException':
+                    print("Iterator for shard {} expired - getting a new one".format(shard_id))
+                    iterators[shard_id] = get_shard_iterator(kinesis, stream_name, shard_id, positions.get(shard_id), 'LATEST')
+                    continue
+                raise
+
+            backoff.pop(shard_id, None)
+            next_poll[shard_id] = time.time() + poll_secs
+
+            records = response['Records']
+            if records:
+                positions[shard_id] = records[-1]['SequenceNumber']
+                # transform_batch expects text - a sub-record that isn't valid utf-8 is left for it to reject
+                yield [data.decode('utf-8', 'replace') for record in records for data in deaggregate(record['Data'])]
+
+            if response.get('NextShardIterator'):
+                iterators[shard_id] = response['NextShardIterator']
+            else:
+                # the shard has been split or merged - read its children from the start
+                print("Shard {} is closed".format(shard_id))
+                closed.add(shard_id)
+                del iterators[shard_id]
+                del next_poll[shard_id]
+
+                for shard in list_shards(kinesis, stream_name):
+                    child_id = shard['ShardId']
+                    if child_id not in iterators and child_id not in closed and \
+                       shard_id in (shard.get('ParentShardId'), shard.get('AdjacentParentShardId')):
+                        iterators[child_id] = get_shard_iterator(kinesis, stream_name, child_id, positions.get(child_id), 'TRIM_HORIZON')
+                        next_poll[child_id] = 0
+
+def ingest(aggregator, lines, event_time):
+    # returns the number of player updates found in the lines
+    # lines are parsed the same way SetPlayerState parses a kinesis batch, so both accept the same events
+    columns, errors = transform_batch(lines, EVENT_FIELDS)
+    updates = 0
+
+    for i in range(len(lines)):
+        if errors[i] is not None or columns[ENRICHMENT_KEY][i] is None:
+            continue
+
+        for player_id, level_id, timestamp in get_player_levels(columns[ENRICHMENT_KEY][i], columns['collector_tstamp'][i]):
+            if event_time:
+                # catch the clock up first, so a player who went quiet before this event is expired before it
+                aggregator.expire(timestamp)
+            else:
+                # SetPlayerState stamps records with the time they were processed
+                timestamp = timenow_millis()
+            aggregator.update(player_id, level_id, timestamp)
+            updates += 1
+
+    return updates
+
+def run(aggregator, source, event_time, interval_secs, output_dir=None, stream_name=None, positions=None):
+    interval_millis = interval_secs * 1000
+
+    records = 0
+    updates = 0
+    next_checkpoint = None
+
+    for lines in source:
+        if lines:
+            records += len(lines)
+            updates += ingest(aggregator, lines, event_time)
+
+        now = aggregator.clock if event_time else timenow_millis()
+        aggregator.expire(now)
+
+        if next_checkpoint is None:
+            next_checkpoint = now + interval_millis
+        elif now >= next_checkpoint:
+            checkpoint(aggregator, interval_secs, output_dir, stream_name, positions)
+            next_checkpoint = now + interval_millis
+
+    checkpoint(aggregator, interval_secs, output_dir, stream_name, positions)
+    return "Processed {} record(s), {} player update(s)".format(records, updates)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fold player, level and transition state in memory")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--stream', help="Kinesis stream of enriched events to consume")
+    source.add_argument('--file', help="file of enriched event TSV lines (optionally gzipped), or - for stdin")
+    parser.add_argument('--event-time', action='store_true',
+                        help="drive expiry and checkpoints from collector timestamps instead of the wall clock (for replays)")
+    parser.add_argument('--output-dir',
+                        help="write the level and transition documents from each checkpoint here instead of S3, and skip DynamoDB")
+    parser.add_argument('--interval', type=int, default=checkpoint_interval_secs,
+                        help="seconds between checkpoints")
+    args = parser.parse_args(argv)
+
+    aggregator = StateAggregator(prune_duration_secs * 1000, tick_secs * 1000)
+    positions = None
+
+    if args.output_dir is None:
+        load_tables(aggregator)
+
+    if args.stream:
+        positions = load_positions(args.stream, args.output_dir)
+        source = read_stream(args.stream, positions)
+    else:
+        source = read_chunks(args.file, batch_size)
+
+    print(run(aggregator, source, args.event_time, args.interval, args.output_dir, args.stream, positions))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Helpers for writing a DynamoDB table snapshot to S3 without holding it in memory.
+
+Items are scanned a page at a time, encoded to JSON one item at a time and uploaded
+in multipart chunks, so peak memory is about one scan page plus one part however
+large the table is. Used by FlushTransitionState and WriteLevelState - deploy this
+file alongside them.
+"""
+
+import json
+
+# S3 will not accept a part smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def scan_items(table, **kwargs):
+    # yield every item in the table, following the scan pages
+    response = table.scan(**kwargs)
+
+    for i in response['Items']:
+        yield i
+
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **kwargs)
+
+        for i in response['Items']:
+            yield i
+
+def iter_json_document(header, name, items, as_object=False, cls=json.JSONEncoder):
+    """
+    Yield a JSON document a piece at a time - the header fields, then a field called
+    name holding items as a list, or as an object if as_object is set (items are
+    then (key, value) pairs). Equivalent to json.dumps of the whole document.
+    """
+    encoder = cls()
+    open_bracket, close_bracket = ('{', '}') if as_object else ('[', ']')
+
+    yield '{\n'
+    for key, value in header.items():
+        yield '  {}: {},\n'.format(encoder.encode(key), encoder.encode(value))
+    yield '  {}: {}'.format(encoder.encode(name), open_bracket)
+
+    separator = '\n    '
+    for item in items:
+        if as_object:
+            yield '{}{}: {}'.format(separator, encoder.encode(item[0]), encoder.encode(item[1]))
+        else:
+            yield separator + encoder.encode(item)
+        separator = ',\n    '
+
+    yield '\n  {}\n}}\n'.format(close_bracket)
+
+
+class S3StreamWriter(object):
+    """
+    File-like writer that uploads to S3 in parts as data arrives.
+
+    Nothing is uploaded until a part's worth has been written; if the whole object
+    turns out smaller than that it is written with a single put_object instead.
+    Used as a context manager the upload is completed on success and aborted if an
+    exception escapes, so a failed snapshot never replaces the previous one.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or MIN_PART_SIZE
+
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+
+        if self.buffered >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=''.join(self.buffer))
+        self.parts.append({ 'PartNumber': part_number, 'ETag': response['ETag'] })
+
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=''.join(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part()
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                     MultipartUpload={ 'Parts': self.parts })
+        self.buffer = []
+        self.buffered = 0
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # the last part or the completion can fail too - the parts already uploaded are billed until aborted
+            try:
+                self.close()
+            except Exception:
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
@@ -2,10 +2,12 @@ import boto3
 import decimal
 from boto3.dynamodb.conditions import Key, Attr
 import json
-from cStringIO import StringIO
 import uuid
 import datetime
 
+from StreamingSnapshot import scan_items, iter_json_document, S3StreamWriter
+from Profiling import profiled
+
 # Convert "decimal" to json - from AWS examples
 # http://docs.aws.amazon.com/amazondynamodb/latest/gettingstartedguide/GettingStarted.Python.03.html
 class DecimalEncoder(json.JSONEncoder):
@@ -27,44 +29,25 @@ def get_level_states():
     fe = Attr('playerCount').gt(0);
     pe = "#level, playerCount"
     ean = { "#level": "levelId", }
-    esk = None
 
-    levels = {}
     levels_found = 0
 
-    response = table.scan(
-        FilterExpression=fe,
-        ProjectionExpression=pe,
-        ExpressionAttributeNames=ean,
-        ConsistentRead = True
-    )
-
-    for i in response['Items']:
-        levels[i['levelId']] = i['playerCount']
+    # yield (level, player count) pairs as they are scanned rather than building a dict of them
+    for i in scan_items(table, FilterExpression=fe, ProjectionExpression=pe, ExpressionAttributeNames=ean, ConsistentRead=True):
+        yield i['levelId'], i['playerCount']
         levels_found += 1
 
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(
-            ProjectionExpression=pe,
-            FilterExpression=fe,
-            ExpressionAttributeNames= ean,
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            ConsistentRead = True
-            )
-
-        for i in response['Items']:
-            levels[i['levelId']] = i['playerCount']
-            levels_found += 1
-
     print("{} level(s) found".format(levels_found))
-    return levels
 
-def write_level_states(json_levels):
+def write_level_states(chunks):
     bucket_name = "sp-codecombat-level-state"
     file_name = "level_information.json"
-    fake_handle = StringIO(json_levels)
-    s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=fake_handle.read())
+    with S3StreamWriter(s3_client, bucket_name, file_name) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.size
 
+@profiled
 def lambda_handler(event, context):
     levels = get_level_states()
     # also add the meta information in here
@@ -73,9 +56,8 @@ def lambda_handler(event, context):
     # interval_secs 60
     update = { 'update_time': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
                'update_id' : str(uuid.uuid4()),
-               'update_interval_secs': 60,
-               'level_player_counts' : levels }
-    as_json = json.dumps(update, indent=2, cls=DecimalEncoder)
-    print(as_json)
-    write_level_states(as_json)
-    return as_json
+               'update_interval_secs': 60 }
+    size = write_level_states(iter_json_document(update, 'level_player_counts', levels, as_object=True, cls=DecimalEncoder))
+    msg = "Wrote {} bytes to level_information.json for update {}".format(size, update['update_id'])
+    print(msg)
+    return msg
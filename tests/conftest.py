@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the handlers live at the top of the repo, and create their boto3 resources on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
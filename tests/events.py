@@ -0,0 +1,25 @@
+import json
+
+from SetPlayerState import ENRICHED_EVENT_FIELD_TYPES
+
+FIELD_INDEXES = dict((field, i) for i, (field, converter) in enumerate(ENRICHED_EVENT_FIELD_TYPES))
+
+
+def enriched_event(**values):
+    # an enriched event TSV line with the given fields set and every other field empty
+    event = [''] * len(ENRICHED_EVENT_FIELD_TYPES)
+    for field, value in values.items():
+        event[FIELD_INDEXES[field]] = value
+    return '\t'.join(event)
+
+def contexts(*entries):
+    # entries are (schema, data) pairs
+    return json.dumps({
+        'schema': 'iglu:com.snowplowanalytics.snowplow/contexts/jsonschema/1-0-0',
+        'data': [{ 'schema': schema, 'data': data } for schema, data in entries]
+    })
+
+def level_event(event_id, player, level, collector_tstamp='2017-02-20 12:00:00.000'):
+    return enriched_event(event_id=event_id, event_fingerprint='fp-' + event_id, collector_tstamp=collector_tstamp,
+                          contexts=contexts(('iglu:com.codecombat/level_context/jsonschema/1-0-0',
+                                             { 'user_id': player, 'level_slug': level })))
@@ -0,0 +1,57 @@
+import gzip
+import io
+import json
+import os
+
+import Backfill
+
+from events import level_event
+
+
+def write_gzipped(path, lines):
+    with io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + u'\n')
+
+def run_backfill(tmpdir, files):
+    out = tmpdir.mkdir('out')
+    Backfill.main(['--state-dir', str(tmpdir.join('state')), '--output-dir', str(out), '--processes', '1',
+                   '--chunk-size', '2', '--as-of', '2017-02-20T12:01:00Z'] + files)
+
+    with open(os.path.join(str(out), Backfill.LEVEL_FILE_NAME)) as f:
+        levels = json.load(f)['level_player_counts']
+    with open(os.path.join(str(out), Backfill.BACKFILL_TRANSITION_FILE_NAME)) as f:
+        transitions = dict(((t['from'], t['to']), t['count']) for t in json.load(f)['transitions'])
+    return levels, transitions
+
+
+def test_gzipped_input(tmpdir):
+    path = str(tmpdir.join('events.tsv.gz'))
+    write_gzipped(path, [
+        level_event('e1', 'p1', 'dungeon', '2017-02-20 12:00:00.000'),
+        level_event('e2', 'p2', u'déjà-vu', '2017-02-20 12:00:01.000'),
+        'not an enriched event',
+        level_event('e3', 'p1', 'forest', '2017-02-20 12:00:02.000'),
+    ])
+
+    levels, transitions = run_backfill(tmpdir, [path])
+
+    assert levels == { 'forest': 1, u'déjà-vu': 1 }
+    assert transitions == { (None, 'dungeon'): 1, ('dungeon', 'forest'): 1, (None, u'déjà-vu'): 1 }
+
+def test_same_millisecond_updates_apply_in_file_order(tmpdir):
+    # zeta sorts after alpha, but alpha was read last so it is where the player ends up
+    first = str(tmpdir.join('first.tsv.gz'))
+    second = str(tmpdir.join('second.tsv.gz'))
+    write_gzipped(first, [
+        level_event('e1', 'p1', 'zeta', '2017-02-20 12:00:00.000'),
+        level_event('e2', 'p1', 'alpha', '2017-02-20 12:00:00.000'),
+    ])
+    write_gzipped(second, [
+        level_event('e3', 'p2', 'zeta', '2017-02-20 12:00:05.000'),
+    ])
+
+    levels, transitions = run_backfill(tmpdir, [second, first])
+
+    assert levels == { 'alpha': 1, 'zeta': 1 }
+    assert transitions == { (None, 'zeta'): 2, ('zeta', 'alpha'): 1 }
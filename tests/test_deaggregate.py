@@ -0,0 +1,58 @@
+import hashlib
+
+from SetPlayerState import deaggregate, KPL_MAGIC
+
+
+# minimal protobuf / KPL encoder for building aggregated records locally
+# https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+
+def varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def length_delimited(field, payload):
+    return varint(field << 3 | 2) + varint(len(payload)) + payload
+
+def aggregated_body(payloads):
+    body = length_delimited(1, b'partition-key')      # partition_key_table
+    for payload in payloads:
+        record = varint(1 << 3 | 0) + varint(0)                     # partition_key_index
+        record += length_delimited(3, payload)                      # data
+        record += length_delimited(4, length_delimited(1, b'tag'))  # tags
+        body += length_delimited(3, record)                         # records
+    return body
+
+def aggregate(payloads):
+    body = aggregated_body(payloads)
+    return KPL_MAGIC + body + hashlib.md5(body).digest()
+
+
+def test_multiple_sub_records():
+    payloads = [b'first\tevent', b'x' * 1000, b'', b'last']
+    assert deaggregate(aggregate(payloads)) == payloads
+
+def test_non_aggregated_record_passes_through():
+    record = b'app\tweb\t2017-01-01 00:00:00.000'
+    assert deaggregate(record) == [record]
+
+def test_digest_mismatch_passes_through():
+    corrupted = bytearray(aggregate([b'a', b'b']))
+    corrupted[-1] ^= 0xff
+    corrupted = bytes(corrupted)
+    assert deaggregate(corrupted) == [corrupted]
+
+def test_truncated_protobuf_returns_nothing():
+    body = aggregated_body([b'abc', b'def'])[:-2]
+    assert deaggregate(KPL_MAGIC + body + hashlib.md5(body).digest()) == []
+
+def test_overrunning_length_returns_nothing():
+    # the record claims to be longer than what is left of the message
+    body = length_delimited(1, b'pk') + varint(3 << 3 | 2) + varint(100) + b'short'
+    assert deaggregate(KPL_MAGIC + body + hashlib.md5(body).digest()) == []
@@ -0,0 +1,84 @@
+import pytest
+
+import SetPlayerState
+from SetPlayerState import BloomFilter, EventDeduplicator
+
+from events import level_event
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000000)
+    monkeypatch.setattr(SetPlayerState, 'timenow_millis', clock)
+    return clock
+
+
+def test_bloom_filter_false_positives_within_capacity():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add("added-{}".format(i))
+
+    assert all("added-{}".format(i) in bloom for i in range(10000))
+    false_positives = sum("other-{}".format(i) in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_time_rotation(clock):
+    dedup = EventDeduplicator(1000, 0.001, 60000)
+    dedup.add('a')
+
+    clock.now += 60000
+    assert dedup.seen('a')   # rotated into the previous filter
+    dedup.add('b')
+
+    clock.now += 60000
+    assert not dedup.seen('a')
+    assert dedup.seen('b')
+
+    clock.now += 2 * 60000
+    assert not dedup.seen('b') # nothing is kept after two idle windows
+
+def test_capacity_rotation(clock):
+    dedup = EventDeduplicator(1000, 0.001, 60000)
+
+    false_positives = 0
+    for i in range(5000):
+        if dedup.seen("event-{}".format(i)):
+            false_positives += 1
+        dedup.add("event-{}".format(i))
+
+    # without rotating early most of the later keys would be reported as seen
+    assert false_positives < 50
+
+    assert dedup.added <= 1000
+    # the last capacity's worth are still remembered
+    assert all(dedup.seen("event-{}".format(i)) for i in range(4000, 5000))
+    # and the filters have not filled up - new keys are still let through
+    false_positives = sum(dedup.seen("new-{}".format(i)) for i in range(10000))
+    assert false_positives < 50
+
+def test_handler_remembers_an_event_only_once_handled(clock, monkeypatch):
+    monkeypatch.setattr(SetPlayerState, 'deduplicator', EventDeduplicator(1000, 0.001, 60000))
+    monkeypatch.setattr(SetPlayerState, 'get_records', lambda event: [level_event('e1', 'p1', 'dungeon')])
+
+    calls = []
+    def update_player_level(player, level, timestamp):
+        calls.append((player, level))
+        if len(calls) == 1:
+            raise RuntimeError("throttled")
+    monkeypatch.setattr(SetPlayerState, 'update_player_level', update_player_level)
+
+    with pytest.raises(RuntimeError):
+        SetPlayerState.lambda_handler({}, None)
+
+    # lambda retries the batch - the event has to go through again
+    assert SetPlayerState.lambda_handler({}, None).endswith("0 duplicate(s) suppressed")
+    # then a redelivery is dropped
+    assert SetPlayerState.lambda_handler({}, None).endswith("1 duplicate(s) suppressed")
+    assert calls == [('p1', 'dungeon'), ('p1', 'dungeon')]
@@ -0,0 +1,134 @@
+import decimal
+import json
+import tempfile
+import tracemalloc
+
+import pytest
+
+import FlushTransitionState
+import StreamingSnapshot
+import WriteLevelState
+
+PAGE_SIZE = 500
+PART_SIZE = 64 * 1024
+
+
+class FakeTable(object):
+    """
+    Paged scan over make_item(0) .. make_item(size - 1), built a page at a time
+    """
+    def __init__(self, size, make_item):
+        self.size = size
+        self.make_item = make_item
+        self.deleted = 0
+
+    def scan(self, ExclusiveStartKey=0, **kwargs):
+        end = min(ExclusiveStartKey + PAGE_SIZE, self.size)
+        response = { 'Items': [self.make_item(i) for i in range(ExclusiveStartKey, end)] }
+        if end < self.size:
+            response['LastEvaluatedKey'] = end
+        return response
+
+    def delete_item(self, **kwargs):
+        self.deleted += 1
+        return {}
+
+
+class FakeS3(object):
+    """
+    Keeps uploaded bodies on disk, so they don't count towards the memory being measured
+    """
+    def __init__(self):
+        self.body = tempfile.TemporaryFile()
+        self.parts = 0
+        self.aborted = False
+
+    def write(self, body):
+        self.body.write(body.encode('utf-8'))
+
+    def put_object(self, Body, **kwargs):
+        self.write(Body)
+
+    def create_multipart_upload(self, **kwargs):
+        return { 'UploadId': 'upload' }
+
+    def upload_part(self, Body, **kwargs):
+        self.write(Body)
+        self.parts += 1
+        return { 'ETag': 'etag-{}'.format(self.parts) }
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+    def document(self):
+        self.body.seek(0)
+        return json.loads(self.body.read().decode('utf-8'))
+
+
+def transition(i):
+    return { 'levelFrom': 'level-{}'.format(i), 'levelTo': 'level-{}'.format(i + 1), 'count': decimal.Decimal(i) }
+
+def level(i):
+    return { 'levelId': 'level-{}'.format(i), 'playerCount': decimal.Decimal(i + 1) }
+
+def run_handler(monkeypatch, module, table, s3):
+    monkeypatch.setattr(module, 'table', table)
+    monkeypatch.setattr(module, 's3_client', s3)
+
+    tracemalloc.start()
+    try:
+        module.lambda_handler({}, None)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    # the handlers log a line per row - keep that out of pytest's capture buffer and the measurement
+    for module in (FlushTransitionState, WriteLevelState):
+        monkeypatch.setattr(module, 'print', lambda *args, **kwargs: None, raising=False)
+    monkeypatch.setattr(StreamingSnapshot, 'MIN_PART_SIZE', PART_SIZE)
+
+@pytest.mark.parametrize('module, make_item', [(FlushTransitionState, transition), (WriteLevelState, level)])
+def test_peak_memory_flat_as_table_grows(monkeypatch, module, make_item):
+    peaks = []
+    for size in (10000, 40000):
+        table = FakeTable(size, make_item)
+        s3 = FakeS3()
+        peaks.append(run_handler(monkeypatch, module, table, s3))
+
+        assert s3.parts > 1
+        document = s3.document()
+        if module is FlushTransitionState:
+            assert len(document['transitions']) == size
+            assert document['transitions'][7] == { 'from': 'level-7', 'to': 'level-8', 'count': 7 }
+            assert table.deleted == size
+        else:
+            assert len(document['level_player_counts']) == size
+            assert document['level_player_counts']['level-7'] == 8
+
+    # four times the rows, about the same peak - one scan page and one part
+    assert peaks[1] < peaks[0] * 1.25, peaks
+
+def test_small_snapshot_is_one_put(monkeypatch):
+    s3 = FakeS3()
+    run_handler(monkeypatch, FlushTransitionState, FakeTable(10, transition), s3)
+    assert s3.parts == 0
+    assert len(s3.document()['transitions']) == 10
+
+def test_failed_completion_aborts_the_upload():
+    class FailingS3(FakeS3):
+        def complete_multipart_upload(self, **kwargs):
+            raise RuntimeError("InternalError")
+
+    s3 = FailingS3()
+    with pytest.raises(RuntimeError):
+        with StreamingSnapshot.S3StreamWriter(s3, 'bucket', 'key', part_size=10) as writer:
+            writer.write('x' * 25)
+            writer.write('y' * 5)
+
+    assert s3.parts == 2
+    assert s3.aborted
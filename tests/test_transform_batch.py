@@ -0,0 +1,57 @@
+import json
+
+from SetPlayerState import transform, transform_batch
+
+from events import enriched_event, contexts, level_event
+
+FIELDS = ['app_id', 'event_id', 'txn_id', 'dvce_ismobile', 'collector_tstamp', 'geo_location',
+          'contexts_com_codecombat_level_context_1', 'contexts_com_acme_duplicated_1',
+          'unstruct_event_com_acme_link_click_1']
+
+
+def unstruct_event(schema, data):
+    return json.dumps({
+        'schema': 'iglu:com.snowplowanalytics.snowplow/unstruct_event/jsonschema/1-0-0',
+        'data': { 'schema': schema, 'data': data }
+    })
+
+GOOD_LINES = [
+    level_event('e1', 'p1', 'dungeon'),
+    enriched_event(app_id='codecombat', event_id='e2', txn_id='42', dvce_ismobile='1',
+                   collector_tstamp='2017-02-20 12:00:01.000', geo_latitude='51.5', geo_longitude='-0.12',
+                   contexts=contexts(('iglu:com.acme/duplicated/jsonschema/1-0-0', { 'value': 1 }),
+                                     ('iglu:com.acme/duplicated/jsonschema/1-0-0', { 'value': 2 })),
+                   unstruct_event=unstruct_event('iglu:com.acme/link_click/jsonschema/1-0-1', { 'target': 'x' })),
+    enriched_event(event_id='e3', dvce_ismobile='0', geo_latitude='51.5'),
+]
+
+
+def test_columns_match_transform():
+    columns, errors = transform_batch(GOOD_LINES, FIELDS)
+
+    assert errors == [None] * len(GOOD_LINES)
+    for i, line in enumerate(GOOD_LINES):
+        event = transform(line)
+        for field in FIELDS:
+            assert columns[field][i] == event.get(field), (i, field)
+
+def test_bad_row_is_masked_without_affecting_the_others():
+    lines = [GOOD_LINES[0], enriched_event(event_id='bad', txn_id='not a number'), 'too\tfew\tfields', GOOD_LINES[1]]
+    columns, errors = transform_batch(lines, FIELDS)
+
+    assert errors[0] is None and errors[3] is None
+    assert len(errors[1]) == 1 and 'txn_id' in errors[1][0]
+    assert errors[2] == ["Expected 131 fields, received 3 fields."]
+
+    for field in FIELDS:
+        assert len(columns[field]) == len(lines)
+        assert columns[field][1] is None and columns[field][2] is None
+        assert columns[field][0] == transform(GOOD_LINES[0]).get(field)
+        assert columns[field][3] == transform(GOOD_LINES[1]).get(field)
+
+def test_repeated_field_gets_one_column():
+    columns, errors = transform_batch(GOOD_LINES, ['event_id', 'event_id', 'txn_id'])
+
+    assert sorted(columns) == ['event_id', 'txn_id']
+    assert columns['event_id'] == ['e1', 'e2', 'e3']
+    assert len(errors) == len(GOOD_LINES)